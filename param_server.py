@@ -1,89 +1,181 @@
 #!/usr/bin/env python3
 
 import os
-import pickledb
+import json
 import logging
 import signal
 import argparse
+import functools
+import collections
+import dataclasses
+from typing import Any, Optional
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from queue import Queue
+
+# Use the faster lxml backend for parameter files when it is installed
+try:
+    from lxml import etree as ET2
+    _HAVE_LXML = True
+except ImportError:
+    ET2 = ET
+    _HAVE_LXML = False
 
 import b9py
 
 QMAX = 10
+DB_FILE = 'param_reg.db'
 _parameter_namespace_pubs = {}
+_parameter_namespace_queues = {}
+
+# Namespaces whose change publisher still has to be advertised from the main loop
+_pending_namespaces = collections.deque()
+
+# Namespace -> parameter db keys in that namespace, kept in insertion order
+_ns_index = collections.defaultdict(dict)
+
+
+@dataclasses.dataclass
+class ParamEntry:
+    __slots__ = ('nodename', 'namespace', 'type', 'name', 'position', 'value')
+
+    nodename: str
+    namespace: str
+    type: str
+    name: str
+    position: Optional[str]
+    value: Any
+
+    @classmethod
+    def from_dict(cls, item: dict):
+        return cls(item['nodename'], item['namespace'], item['type'],
+                   item['name'], item.get('position'), item['value'])
 
+    def to_dict(self):
+        # Shallow, the value is shared with the stored entry
+        return {field: getattr(self, field) for field in self.__slots__}
 
-# Control-C handler
+
+# Control-C and SIGTERM handler
 def shutdown_handler(_sig, _frame):
-    os.kill(os.getpid(), signal.SIGKILL)
+    global dbParam
+
+    try:
+        # Persist the parameter db before going down, writing it aside first
+        # so a failed dump never leaves a truncated db file behind
+        with open(DB_FILE + ".tmp", "wt") as f:
+            json.dump({pname: item.to_dict() for pname, item in dbParam.items()}, f)
+        os.replace(DB_FILE + ".tmp", DB_FILE)
+    except Exception as e:
+        logging.error("Unable to save parameter db. {}".format(e))
+    finally:
+        os._exit(0)
+
+
+def load_parameter_db():
+    # The loaded dicts are released on return, only the ParamEntry copies are kept
+    try:
+        with open(DB_FILE, "rt") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {}
+            stored = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {pname: ParamEntry.from_dict(item) for pname, item in stored.items()}
+
+
+def index_parameter_names():
+    global dbParam
+
+    _ns_index.clear()
+    for pname, item in dbParam.items():
+        _ns_index[item.namespace][pname] = None
+
+
+def parameters_in(namespace):
+    global dbParam
+
+    if namespace == '@':
+        return dbParam.values()
+    return [dbParam[pname] for pname in _ns_index.get(namespace, ())]
+
+
+@functools.lru_cache(maxsize=256)
+def _missing_parameter_result(namespace, name):
+    return {'namespace': namespace,
+            'type': 'String',
+            'name': name,
+            'value': '?',
+            'found': False}
 
 
 def get_parameter_from_db(namespace, name):
     global dbParam
 
     param_name = namespace + "/" + name
-    if not dbParam.exists(param_name):
+    existing_item = dbParam.get(param_name)
+    if existing_item is None:
         logging.debug("{} parameter is not set.".format(param_name))
-        result = {'namespace': namespace,
-                  'type': 'String',
-                  'name': name,
-                  'value': '?',
-                  'found': False}
-        msg = b9py.MessageFactory.create_message_dictionary(result)
+        # Each reply gets its own message and copy of the cached result
+        msg = b9py.MessageFactory.create_message_dictionary(dict(_missing_parameter_result(namespace, name)))
     else:
-        existing_item = dbParam.get(param_name)
-        existing_item['found'] = True
-        msg = b9py.MessageFactory.create_message_dictionary(existing_item)
+        result = existing_item.to_dict()
+        result['found'] = True
+        msg = b9py.MessageFactory.create_message_dictionary(result)
 
     return msg
 
 
+def advertise_change_publisher(namespace):
+    # Create parameter changed publisher for this parameter's namespace
+    change_topic = "parameter/changed"
+    pub = b9.create_publisher(change_topic, b9py.Message.MSGTYPE_DICT, namespace)
+    status = pub.advertise()
+    if not status.is_successful:
+        logging.error("Publisher for /{}/{} failed to advertise.".format(namespace, change_topic))
+        return None
+    return pub
+
+
 def put_parameter_in_db(namespace, nodename, value_type, name, value, publish_change=False):
     global dbParam
 
-    # Create the parameter namespace queue
-    if namespace not in _parameter_namespace_pubs.keys():
-        q = Queue(maxsize=QMAX)
-        _parameter_namespace_pubs[namespace] = [q]
+    # Create the parameter namespace queue, its change publisher is advertised in process_changes
+    ns_queue = _parameter_namespace_queues.get(namespace)
+    if ns_queue is None:
+        ns_queue = collections.deque(maxlen=QMAX)
+        _parameter_namespace_queues[namespace] = ns_queue
+        _pending_namespaces.append(namespace)
 
-    pname = name
-    pos = None
-    if ':' in name:
-        pname, pos = name.split(":")
+    pname, sep, pos = name.partition(":")
+    if not sep:
+        pos = None
 
     # Create the change entry and place it in the parameter's namespace queue
     param_name = namespace + "/" + pname
-    param_entry = {'nodename': nodename,
-                   'namespace': namespace,
-                   'type': value_type,
-                   'name': pname,
-                   'position': pos,
-                   'value': value}
+    param_entry = ParamEntry(nodename, namespace, value_type, pname, pos, value)
+    existing_item = dbParam.get(param_name)
 
     # Add an element to a List or Dict
     if pos is not None:
         # Add an element to an existing List of Dict parameter value
-        if dbParam.exists(param_name):
+        if existing_item is not None:
             # Only can modify an existing parameter List or Dict value
-            existing_item = dbParam.get(param_name)
-            if type(existing_item['value']) == list:
+            existing_value = existing_item.value
+            if isinstance(existing_value, list):
                 if pos == '[':
                     # Add to head
-                    existing_item['value'].insert(0, value)
+                    existing_value.insert(0, value)
                 elif pos == ']':
                     # Add to tail
-                    existing_item['value'].append(value)
+                    existing_value.append(value)
                 else:
                     logging.error("Invalid position specified for a list. Must be a '[' or ']'")
-                param_entry['value'] = existing_item['value']
-                param_entry['type'] = b9py.Message.MSGTYPE_LIST
+                param_entry.value = existing_value
+                param_entry.type = b9py.Message.MSGTYPE_LIST
 
-            elif type(existing_item['value']) == dict:
-                existing_item['value'][pos] = value
-                param_entry['value'] = existing_item['value']
-                param_entry['type'] = b9py.Message.MSGTYPE_DICT
+            elif isinstance(existing_value, dict):
+                existing_value[pos] = value
+                param_entry.value = existing_value
+                param_entry.type = b9py.Message.MSGTYPE_DICT
 
             else:
                 logging.warning(
@@ -92,32 +184,38 @@ def put_parameter_in_db(namespace, nodename, value_type, name, value, publish_ch
             logging.warning(
                 "Parameter '{}' must initialized to a List or Dict to add elements.".format(param_name))
 
-    dbParam.set(param_name, param_entry)
+    # The same key can come from different namespaces ('a/b' + 'c' and 'a' + 'b/c'),
+    # so drop it from the namespace of the entry being replaced
+    if existing_item is not None and existing_item.namespace != namespace:
+        _ns_index[existing_item.namespace].pop(param_name, None)
+
+    dbParam[param_name] = param_entry
+    _ns_index[namespace][param_name] = None
 
     if publish_change:
-        # Queue up changed parameter to be published
-        queue: Queue = _parameter_namespace_pubs[namespace][0]
-        if queue.qsize() == QMAX:
-            queue.get_nowait()
-        queue.put_nowait(param_entry)
+        # Queue up changed parameter to be published, the oldest change is dropped when full
+        ns_queue.append(param_entry)
 
 
 def load_parameter_from_xml(element: ET.Element, publish_change):
-    put_parameter_in_db(element.attrib['ns'], "default",
-                        element.attrib['type'], element.attrib['name'], element.attrib['value'],
+    attrib = element.attrib
+    put_parameter_in_db(attrib['ns'], "default",
+                        attrib['type'], attrib['name'], attrib['value'],
                         publish_change=publish_change)
 
 
 def load_parameters_from_file(filename, namespace, publish_change):
     try:
-        tree = ET.parse("parameters/" + filename)
-
-        # Process each parameter node
-        root = tree.getroot()
-        for child in root:
-            if child.tag == "parameter":
-                if namespace == '@' or namespace == child.attrib['ns']:
-                    load_parameter_from_xml(child, publish_change)
+        # Stream each parameter node and release it once processed
+        for _event, elem in ET2.iterparse("parameters/" + filename, events=("end",)):
+            if elem.tag == "parameter":
+                if namespace == '@' or namespace == elem.attrib['ns']:
+                    load_parameter_from_xml(elem, publish_change)
+                elem.clear()
+                if _HAVE_LXML:
+                    # Drop the already processed siblings still held by the root
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
 
         logging.info("Loaded parameters file named '{}'.".format(args['parameters']))
         return True
@@ -128,103 +226,112 @@ def load_parameters_from_file(filename, namespace, publish_change):
 
 
 def save_parameters_to_file(filename, namespace):
-    global dbParam
+    root = ET2.Element('parameters')
+    for existing_item in parameters_in(namespace):
+        param_el = ET2.SubElement(root, 'parameter')
+        param_el.attrib["ns"] = existing_item.namespace
+        param_el.attrib["name"] = existing_item.name
+        param_el.attrib["type"] = existing_item.type
+        param_el.attrib["value"] = str(existing_item.value)
 
-    root = ET.Element('parameters')
-    for pname in dbParam.getall():
-        existing_item = dbParam.get(pname)
+    tree = ET2.ElementTree(root)
+    if hasattr(ET2, 'indent'):
+        # ElementTree.indent is only available in Python 3.9+
+        ET2.indent(tree, space="   ")
+    tree.write("parameters/" + filename, encoding="utf-8", xml_declaration=True)
 
-        if namespace == '@' or namespace == existing_item['namespace']:
-            param_el = ET.SubElement(root, 'parameter')
-            param_el.attrib["ns"] = existing_item['namespace']
-            param_el.attrib["name"] = existing_item['name']
-            param_el.attrib["type"] = existing_item['type']
-            param_el.attrib["value"] = existing_item['value']
 
-    xmlstr = minidom.parseString(ET.tostring(root)).toprettyxml(indent="   ")
-    with open("parameters/" + filename, "w") as f:
-        f.write(xmlstr)
+# Put a value in the parameter db
+def _handle_put(data: dict):
+    put_parameter_in_db(data['namespace'], data['nodename'],
+                        data['type'], data['name'], data['value'],
+                        publish_change=True)
 
 
-def parameter_cb(_request_topic, message: b9py.Message):
+# Get a value from the parameter db
+def _handle_get(data: dict):
+    return get_parameter_from_db(data['namespace'], data['name'])
+
+
+# List all name/values in the parameter db
+def _handle_list(data: dict):
+    item_list = [item.to_dict() for item in parameters_in(data['namespace'])]
+    return b9py.MessageFactory.create_message_list(item_list)
+
+
+# Purge all values from the parameter db
+def _handle_purge(data: dict):
     global dbParam
 
-    msg = b9py.MessageFactory.create_message_string("OK", param_srv.name)
-
-    # Put a value in the parameter db
-    if message.data['cmd'].lower() == 'put':
-        put_parameter_in_db(message.data['namespace'], message.data['nodename'],
-                            message.data['type'], message.data['name'], message.data['value'],
-                            publish_change=True)
-
-    # Get a value from the parameter db
-    elif message.data['cmd'].lower() == 'get':
-        msg = get_parameter_from_db(message.data['namespace'], message.data['name'])
-
-    # List all name/values in the parameter db
-    elif message.data['cmd'].lower() == 'list':
-        item_list = []
-        for pname in dbParam.getall():
-            existing_item = dbParam.get(pname)
-            if message.data['namespace'] == '@' or message.data['namespace'] == existing_item['namespace']:
-                item_list.append(existing_item)
-        msg = b9py.MessageFactory.create_message_list(item_list)
-
-    # Purge all values from the parameter db
-    elif message.data['cmd'].lower() == 'purge':
-        if message.data['namespace'] == '@':
-            dbParam.deldb()
-        else:
-            pkeys = []
-            for key in dbParam.getall():
-                pkeys.append(key)
-            for pname in pkeys:
-                existing_item = dbParam.get(pname)
-                if message.data['namespace'] == existing_item['namespace']:
-                    dbParam.rem(pname)
-
-    # Save all parameter db to an XML file
-    elif message.data['cmd'].lower() == 'save':
-        save_parameters_to_file(message.data['filename'], message.data['namespace'])
-
-    # Load parameter db from an XML file
-    elif message.data['cmd'].lower() == 'load':
-        load_parameters_from_file(message.data['filename'], message.data['namespace'], message.data['publish_change'])
+    if data['namespace'] == '@':
+        dbParam.clear()
+        _ns_index.clear()
+    else:
+        for pname in _ns_index.pop(data['namespace'], ()):
+            del dbParam[pname]
+
+
+# Save all parameter db to an XML file
+def _handle_save(data: dict):
+    save_parameters_to_file(data['filename'], data['namespace'])
 
+
+# Load parameter db from an XML file
+def _handle_load(data: dict):
+    load_parameters_from_file(data['filename'], data['namespace'], data['publish_change'])
+
+
+_CMD_DISPATCH = {'put': _handle_put,
+                 'get': _handle_get,
+                 'list': _handle_list,
+                 'purge': _handle_purge,
+                 'save': _handle_save,
+                 'load': _handle_load}
+
+
+def parameter_cb(_request_topic, message: b9py.Message):
+    msg = None
+
+    data = message.data
+    cmd = data['cmd']
+    handler = _CMD_DISPATCH.get(cmd)
+    if handler is None:
+        # Commands are expected in lowercase, still accept any case from older clients
+        handler = _CMD_DISPATCH.get(cmd.lower())
+    if handler is not None:
+        msg = handler(data)
+
+    # Commands without a reply of their own just acknowledge the request
+    if msg is None:
+        msg = b9py.MessageFactory.create_message_string("OK", param_srv.name)
     return msg
 
 
 def process_changes():
     global _parameter_namespace_pubs
 
-    for param_ns in _parameter_namespace_pubs:
-        entry = _parameter_namespace_pubs[param_ns]
-        if len(entry) == 1:
-            # Create parameter changed publisher for this parameter's namespace
-            change_topic = "parameter/changed"
-            pub = b9.create_publisher(change_topic, b9py.Message.MSGTYPE_DICT, param_ns)
-            status = pub.advertise()
-            if status.is_successful:
-                _parameter_namespace_pubs[param_ns] = [entry[0], pub]
-            else:
-                _parameter_namespace_pubs[param_ns] = [entry[0], None]
-                logging.error("Publisher for /{}/{} failed to advertise.".format(param_ns, change_topic))
+    # Advertise change publishers for namespaces first used since the last spin
+    while _pending_namespaces:
+        param_ns = _pending_namespaces.popleft()
+        pub = advertise_change_publisher(param_ns)
+        if pub is not None:
+            _parameter_namespace_pubs[param_ns] = (_parameter_namespace_queues[param_ns], pub)
         else:
-            if entry[1] is not None:
-                # We have a publisher so publish the damn parameter change to anyone who fucking cares
-                queue, pub = _parameter_namespace_pubs[param_ns]
-                if queue.qsize() > 0:
-                    param_entry = queue.get_nowait()
-                    logging.info("Parameter change: {}, {} = {}".format(param_ns,
-                                                                        param_entry['name'],
-                                                                        param_entry['value']))
-                    msg = b9py.MessageFactory.create_message_dictionary(param_entry)
-                    pub.publish(msg)
+            # No publisher, so a zero length queue drops this namespace's changes
+            _parameter_namespace_queues[param_ns] = collections.deque(maxlen=0)
 
+    for param_ns, (queue, pub) in _parameter_namespace_pubs.items():
+        if queue:
+            # Publish the damn parameter change to anyone who fucking cares
+            param_entry = queue.popleft()
+            logging.info("Parameter change: {}, {} = {}".format(param_ns,
+                                                                param_entry.name,
+                                                                param_entry.value))
+            msg = b9py.MessageFactory.create_message_dictionary(param_entry.to_dict())
+            pub.publish(msg)
 
-if __name__ == "__main__":
-    signal.signal(signal.SIGINT, shutdown_handler)
 
+if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("-n", "--nodename", type=str, default="parameter_server", help="node name")
     ap.add_argument("-s", "--namespace", type=str, default="", help="parameter service namespace")
@@ -236,8 +343,13 @@ if __name__ == "__main__":
     b9 = b9py.B9(args['nodename'])
     b9.start_logger(level=logging.INFO)
 
-    # Database
-    dbParam = pickledb.load('param_reg.db', auto_dump=False)
+    # Database, the parameters themselves are worked on as a plain dict
+    dbParam = load_parameter_db()
+    index_parameter_names()
+
+    # Only hook Control-C and SIGTERM once there is a db to save
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
 
     # Setup Parameter Service
     param_srv = b9.create_service(args['topic'], b9py.Message.MSGTYPE_PARAMETER, parameter_cb, args['namespace'])